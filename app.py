@@ -4,9 +4,14 @@ import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import joblib
-from sqlalchemy import create_engine
 from datetime import datetime, timedelta
 import numpy as np
+from sqlalchemy.exc import ProgrammingError
+
+from scripts.cohorts import load_bitmaps, retention_matrix, repeat_rate, churn_series
+from scripts.db_router import DatabaseRouter, get_setting
+from scripts.query_governor import QueryGovernor, QueryTimeout, StaleResult
+from scripts.revenue_monitor import load_kpi_deltas
 
 # ==================== PAGE CONFIGURATION ====================
 st.set_page_config(
@@ -18,12 +23,18 @@ st.set_page_config(
 
 # ==================== DATABASE & MODEL INITIALIZATION ====================
 @st.cache_resource
-@st.cache_resource
 def init_connection():
-    return create_engine(
-        st.secrets["DB_URL"],
-        pool_pre_ping=True,
-        pool_recycle=300
+    """Primary for writes, lag-checked replicas for dashboard reads"""
+    return DatabaseRouter.from_settings()
+
+
+@st.cache_resource
+def init_governor(_router):
+    """Shared across sessions so concurrent reruns are throttled and coalesced"""
+    return QueryGovernor(
+        _router,
+        max_heavy_queries=int(get_setting("MAX_HEAVY_QUERIES", 4)),
+        statement_timeout_ms=int(get_setting("STATEMENT_TIMEOUT_MS", 15000))
     )
 
 
@@ -36,9 +47,96 @@ def load_model():
         st.warning("⚠️ Predictive model not found. Forecast features disabled.")
         return None
 
-engine = init_connection()
+router = init_connection()
+governor = init_governor(router)
 model = load_model()
 
+
+def governed(loader, *args, columns=(), fallback=None, **kwargs):
+    """Run a governed query; on timeout show its last good result, or `fallback()` / an empty frame with `columns`"""
+    try:
+        return loader(*args, **kwargs)
+    except StaleResult as stale:
+        st.warning("⚠️ Database is busy. Showing the last available data for this view.")
+        return stale.frame
+    except QueryTimeout:
+        st.warning("⚠️ Database is busy and this view is unavailable right now. Please retry in a moment.")
+        return fallback() if fallback else pd.DataFrame(columns=list(columns))
+
+
+def run_governed(load, *args, heavy=True):
+    """Call `load(read_sql, *args)` with queries routed through the governor.
+
+    If any of its queries fell back to a last good result, the whole result is
+    raised as StaleResult so st.cache_data does not keep it as fresh.
+    """
+    stale = []
+
+    def read_sql(sql, params=None):
+        try:
+            return governor.read_sql(sql, params=params, heavy=heavy)
+        except StaleResult as exc:
+            stale.append(exc)
+            return exc.frame
+
+    result = load(read_sql, *args)
+    if stale:
+        raise StaleResult(result, stale[0])
+    return result
+
+
+def is_missing_table(exc):
+    """True for Postgres undefined_table, i.e. a derived table that has not been built yet"""
+    return getattr(exc.orig, "pgcode", None) == "42P01"
+
+# ==================== CHART HELPERS ====================
+GRANULARITIES = {
+    "Daily": "day",
+    "Weekly": "week",
+    "Monthly": "month",
+    "Quarterly": "quarter"
+}
+MAX_POINTS_PER_SERIES = 400
+
+
+def lttb_indices(x, y, threshold):
+    """Row positions kept by Largest-Triangle-Three-Buckets downsampling"""
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    bucket_size = (n - 2) / (threshold - 2)
+
+    keep = np.empty(threshold, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+
+        # Third triangle vertex is the average of the following bucket
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def downsample(df, x_col, y_col, threshold=MAX_POINTS_PER_SERIES):
+    """Downsample a time series frame to at most `threshold` rows with LTTB"""
+    if len(df) <= threshold:
+        return df
+    x = (df[x_col] - df[x_col].min()).dt.total_seconds()
+    return df.iloc[lttb_indices(x, df[y_col], threshold)]
+
 # ==================== PROFESSIONAL STYLING ====================
 st.markdown("""
 <style>
@@ -254,17 +352,23 @@ with st.sidebar:
     st.markdown("---")
     
     st.markdown("<h3 style='color: #ffffff !important; font-size: 20px;'>🌍 Location</h3>", unsafe_allow_html=True)
-    cities_df = pd.read_sql("SELECT DISTINCT city FROM customers ORDER BY city", engine)
+    cities_df = governed(governor.read_sql, "SELECT DISTINCT city FROM customers ORDER BY city", heavy=False, columns=["city"])
     city = st.selectbox("Select City", ["All"] + list(cities_df['city']), label_visibility="collapsed")
     
     st.markdown("---")
     
     st.markdown("<h3 style='color: #ffffff !important; font-size: 20px;'>📦 Product Category</h3>", unsafe_allow_html=True)
-    cat_df = pd.read_sql("SELECT DISTINCT categoty FROM products ORDER BY categoty", engine)
+    cat_df = governed(governor.read_sql, "SELECT DISTINCT categoty FROM products ORDER BY categoty", heavy=False, columns=["categoty"])
     cat = st.selectbox("Select Category", ["All"] + list(cat_df['categoty']), label_visibility="collapsed")
     
     st.markdown("---")
     
+    st.markdown("<h3 style='color: #ffffff !important; font-size: 20px;'>⏱️ Time Granularity</h3>", unsafe_allow_html=True)
+    granularity_label = st.selectbox("Select Granularity", list(GRANULARITIES), index=2, label_visibility="collapsed")
+    granularity = GRANULARITIES[granularity_label]
+    
+    st.markdown("---")
+    
     if st.button("🔄 Refresh Data", use_container_width=True):
         st.cache_data.clear()
         st.rerun()
@@ -295,7 +399,7 @@ st.markdown("<p class='sub-header'>Real-time Business Intelligence & Predictive
 # ==================== KPI METRICS ====================
 @st.cache_data(ttl=300)
 def get_kpi_data(filter_sql):
-    return pd.read_sql(f"""
+    return governor.read_sql(f"""
         SELECT 
             p.categoty AS category,
             SUM(s.quantity * p.price) AS revenue,
@@ -307,15 +411,46 @@ def get_kpi_data(filter_sql):
         JOIN customers c ON s.customer_id = c.customer_id
         WHERE 1=1 {filter_sql}
         GROUP BY p.categoty
-    """, engine)
+    """)
 
-kpi_data = get_kpi_data(filter_sql)
+kpi_data = governed(get_kpi_data, filter_sql, columns=['category', 'revenue', 'customers', 'total_quantity', 'total_orders'])
 
 total_revenue = kpi_data['revenue'].sum()
 total_customers = kpi_data['customers'].sum()
 total_orders = kpi_data['total_orders'].sum()
 avg_order_value = total_revenue / total_orders if total_orders > 0 else 0
 
+@st.cache_data(ttl=300)
+def get_kpi_deltas(city, cat):
+    try:
+        return run_governed(load_kpi_deltas, city, cat, heavy=False)
+    except ProgrammingError as exc:
+        if not is_missing_table(exc):
+            raise
+        return None
+
+kpi_deltas = governed(get_kpi_deltas, city, cat, fallback=lambda: None)
+
+def kpi_change(key, fmt):
+    """Month-to-date value and its change vs the same days of last month, from the revenue monitor"""
+    metric = kpi_deltas[key] if kpi_deltas else None
+    if metric is None:
+        return "<div class='kpi-change'>— no month-to-date data</div>"
+    through = f"1–{kpi_deltas['through_day']} {kpi_deltas['period_start'].strftime('%b')}"
+    current = f"<div class='kpi-change'>Month to date ({through}): {fmt(metric['current'])}</div>"
+    change = metric['change']
+    if change is None:
+        return current + "<div class='kpi-change'>— no sales in the same days last month</div>"
+    if change >= 0:
+        return current + f"<div class='kpi-change positive'>↑ {change:.1f}% vs same days last month</div>"
+    return current + f"<div class='kpi-change negative'>↓ {abs(change):.1f}% vs same days last month</div>"
+
+def format_rupees(value):
+    return f"₹{int(value):,}"
+
+def format_count(value):
+    return f"{int(value):,}"
+
 col1, col2, col3, col4 = st.columns(4)
 
 with col1:
@@ -323,7 +458,7 @@ with col1:
         <div class='kpi-card'>
             <div class='kpi-title'>💰 TOTAL REVENUE</div>
             <div class='kpi-value'>₹{int(total_revenue):,}</div>
-            <div class='kpi-change positive'>↑ 12.5% vs last period</div>
+            {kpi_change('revenue', format_rupees)}
         </div>
     """, unsafe_allow_html=True)
 
@@ -332,7 +467,7 @@ with col2:
         <div class='kpi-card'>
             <div class='kpi-title'>👥 ACTIVE CUSTOMERS</div>
             <div class='kpi-value'>{int(total_customers):,}</div>
-            <div class='kpi-change positive'>↑ 8.3% vs last period</div>
+            {kpi_change('customers', format_count)}
         </div>
     """, unsafe_allow_html=True)
 
@@ -341,7 +476,7 @@ with col3:
         <div class='kpi-card'>
             <div class='kpi-title'>📦 TOTAL ORDERS</div>
             <div class='kpi-value'>{int(total_orders):,}</div>
-            <div class='kpi-change positive'>↑ 15.7% vs last period</div>
+            {kpi_change('orders', format_count)}
         </div>
     """, unsafe_allow_html=True)
 
@@ -350,40 +485,52 @@ with col4:
         <div class='kpi-card'>
             <div class='kpi-title'>💳 AVG ORDER VALUE</div>
             <div class='kpi-value'>₹{int(avg_order_value):,}</div>
-            <div class='kpi-change negative'>↓ 2.1% vs last period</div>
+            {kpi_change('avg_order_value', format_rupees)}
         </div>
     """, unsafe_allow_html=True)
 
+if kpi_deltas and kpi_deltas['alert']:
+    alert = kpi_deltas['alert']
+    direction = "spike" if alert['z'] > 0 else "drop"
+    st.warning(
+        f"⚠️ Revenue {direction} on {alert['day'].strftime('%d %b %Y')}: "
+        f"₹{int(alert['revenue']):,} ({alert['z']:+.1f}σ from the daily trend)"
+    )
+
 # ==================== REVENUE ANALYTICS ====================
 st.markdown("<h2 class='section-header'>📈 Revenue Analytics</h2>", unsafe_allow_html=True)
 
 col1, col2 = st.columns([2, 1])
 
 with col1:
-    st.markdown("#### Monthly Revenue Trend with Moving Average")
+    st.markdown(f"#### {granularity_label} Revenue Trend with Moving Average")
     
     @st.cache_data(ttl=300)
-    def get_trend_data(filter_sql):
-        return pd.read_sql(f"""
+    def get_trend_data(filter_sql, granularity):
+        return governor.read_sql(f"""
             SELECT 
-                DATE_TRUNC('month', sale_date) AS month,
-                SUM(s.quantity * p.price) AS revenue
+                DATE_TRUNC('{granularity}', sale_date)::date AS period,
+                SUM(s.quantity * p.price) AS revenue,
+                AVG(SUM(s.quantity * p.price)) OVER (
+                    ORDER BY DATE_TRUNC('{granularity}', sale_date)::date
+                    ROWS BETWEEN 2 PRECEDING AND CURRENT ROW
+                ) AS ma_3
             FROM sales s 
             JOIN products p ON s.product_id = p.product_id
             JOIN customers c ON s.customer_id = c.customer_id
             WHERE 1=1 {filter_sql}
-            GROUP BY month 
-            ORDER BY month
-        """, engine)
+            GROUP BY period 
+            ORDER BY period
+        """, parse_dates=['period'])
     
-    trend_data = get_trend_data(filter_sql)
+    trend_data = governed(get_trend_data, filter_sql, granularity, columns=['period', 'revenue', 'ma_3'])
     
     if not trend_data.empty:
-        trend_data['ma_3'] = trend_data['revenue'].rolling(window=3, min_periods=1).mean()
+        trend_data = downsample(trend_data, 'period', 'revenue')
         
         fig = go.Figure()
         fig.add_trace(go.Scatter(
-            x=trend_data['month'], 
+            x=trend_data['period'], 
             y=trend_data['revenue'],
             mode='lines+markers',
             name='Revenue',
@@ -391,10 +538,10 @@ with col1:
             marker=dict(size=8)
         ))
         fig.add_trace(go.Scatter(
-            x=trend_data['month'], 
+            x=trend_data['period'], 
             y=trend_data['ma_3'],
             mode='lines',
-            name='3-Month MA',
+            name=f'3-{granularity.title()} MA',
             line=dict(color='#f59e0b', width=2, dash='dash')
         ))
         
@@ -446,7 +593,7 @@ with col1:
     
     @st.cache_data(ttl=300)
     def get_segment_data(filter_sql):
-        return pd.read_sql(f"""
+        return governor.read_sql(f"""
             SELECT 
                 c.city, 
                 COUNT(DISTINCT s.customer_id) AS customers,
@@ -457,9 +604,9 @@ with col1:
             WHERE 1=1 {filter_sql}
             GROUP BY c.city
             ORDER BY revenue DESC
-        """, engine)
+        """)
     
-    segment_data = get_segment_data(filter_sql)
+    segment_data = governed(get_segment_data, filter_sql, columns=['city', 'customers', 'revenue'])
     
     if not segment_data.empty:
         fig = px.bar(
@@ -505,6 +652,78 @@ with col2:
         )
         st.plotly_chart(fig, use_container_width=True)
 
+# ==================== COHORT & RETENTION ANALYTICS ====================
+st.markdown("<h2 class='section-header'>🔁 Cohort & Retention Analytics</h2>", unsafe_allow_html=True)
+
+@st.cache_data(ttl=300)
+def get_customer_bitmaps(city, cat):
+    try:
+        return run_governed(load_bitmaps, city, cat)
+    except ProgrammingError as exc:
+        if not is_missing_table(exc):
+            raise
+        return {}
+
+bitmaps = governed(get_customer_bitmaps, city, cat, fallback=lambda: None)
+
+if bitmaps is None:
+    pass
+elif not bitmaps:
+    st.info("Customer bitmaps not built yet. Run `python -m scripts.cohorts` to enable cohort analytics.")
+else:
+    retention = retention_matrix(bitmaps)
+    churn = churn_series(bitmaps)
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Repeat Purchase Rate", f"{repeat_rate(bitmaps):.1f}%")
+    with col2:
+        st.metric("Latest Monthly Churn", f"{churn['churn_rate'].iloc[-1]:.1f}%" if not churn.empty else "—")
+    with col3:
+        st.metric("Cohorts Tracked", len(retention))
+    
+    col1, col2 = st.columns([3, 2])
+    
+    with col1:
+        st.markdown("#### Monthly Cohort Retention (%)")
+        
+        if not retention.empty:
+            fig = px.imshow(
+                retention,
+                labels=dict(x="Months Since First Purchase", y="Cohort", color="Retention %"),
+                color_continuous_scale='Purples',
+                text_auto='.0f',
+                aspect='auto'
+            )
+            fig.update_layout(
+                template='plotly_dark',
+                height=450,
+                xaxis=dict(tickfont=dict(color='#ffffff')),
+                yaxis=dict(tickfont=dict(color='#ffffff')),
+                margin=dict(l=20, r=20, t=20, b=60)
+            )
+            st.plotly_chart(fig, use_container_width=True)
+    
+    with col2:
+        st.markdown("#### Month-over-Month Churn")
+        
+        if not churn.empty:
+            fig = go.Figure(data=[go.Scatter(
+                x=churn['period'],
+                y=churn['churn_rate'],
+                mode='lines+markers',
+                name='Churn %',
+                line=dict(color='#f87171', width=3)
+            )])
+            fig.update_layout(
+                template='plotly_dark',
+                height=450,
+                xaxis=dict(tickfont=dict(color='#ffffff')),
+                yaxis=dict(title="Churn (%)", tickfont=dict(color='#ffffff')),
+                margin=dict(l=20, r=20, t=20, b=60)
+            )
+            st.plotly_chart(fig, use_container_width=True)
+
 # ==================== PRODUCT ANALYTICS ====================
 st.markdown("<h2 class='section-header'>📦 Product Performance Analysis</h2>", unsafe_allow_html=True)
 
@@ -513,7 +732,7 @@ tab1, tab2, tab3 = st.tabs(["🏆 Top Products", "📊 Product Matrix", "📉 Pe
 with tab1:
     @st.cache_data(ttl=300)
     def get_product_data():
-        return pd.read_sql("""
+        return governor.read_sql("""
             SELECT 
                 p.product_name,
                 p.categoty as category,
@@ -525,9 +744,9 @@ with tab1:
             GROUP BY p.product_name, p.categoty
             ORDER BY revenue DESC
             LIMIT 20
-        """, engine)
+        """)
     
-    product_data = get_product_data()
+    product_data = governed(get_product_data, columns=['product_name', 'category', 'revenue', 'quantity_sold', 'customers'])
     
     if not product_data.empty:
         product_display = product_data.copy()
@@ -557,22 +776,26 @@ with tab2:
 
 with tab3:
     @st.cache_data(ttl=300)
-    def get_category_trend():
-        return pd.read_sql("""
+    def get_category_trend(granularity):
+        return governor.read_sql(f"""
             SELECT 
-                DATE_TRUNC('month', sale_date) AS month,
+                DATE_TRUNC('{granularity}', sale_date)::date AS period,
                 p.categoty as category,
                 SUM(s.quantity * p.price) AS revenue
             FROM sales s 
             JOIN products p ON s.product_id = p.product_id
-            GROUP BY month, category
-            ORDER BY month, category
-        """, engine)
+            GROUP BY period, category
+            ORDER BY period, category
+        """, parse_dates=['period'])
     
-    cat_trend = get_category_trend()
+    cat_trend = governed(get_category_trend, granularity, columns=['period', 'category', 'revenue'])
     
     if not cat_trend.empty:
-        fig = px.line(cat_trend, x='month', y='revenue', color='category')
+        cat_trend = pd.concat(
+            downsample(series, 'period', 'revenue')
+            for _, series in cat_trend.groupby('category', sort=False)
+        )
+        fig = px.line(cat_trend, x='period', y='revenue', color='category')
         fig.update_layout(
             template='plotly_dark',
             height=450,
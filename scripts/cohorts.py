@@ -0,0 +1,192 @@
+import zlib
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+# One compressed customer bitmap per (month, city, category) segment. Like
+# roaring's array containers, a bitmap is a sorted array of unique customer
+# IDs, stored delta-encoded and zlib-compressed, so its size follows the
+# number of customers rather than the largest ID. Retention, repeat-rate and
+# churn reduce to vectorised intersections, unions and differences.
+# Customers without a city and products without a category are grouped here
+UNKNOWN_SEGMENT = "Unknown"
+
+BITMAP_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS customer_bitmaps (
+    period DATE NOT NULL,
+    city VARCHAR(50) NOT NULL,
+    category VARCHAR(50) NOT NULL,
+    customers BYTEA NOT NULL,
+    PRIMARY KEY (period, city, category)
+)
+"""
+
+
+EMPTY_BITMAP = np.empty(0, dtype=np.int64)
+
+
+def bitmap_from_ids(customer_ids):
+    """Sorted array of the unique customer IDs"""
+    return np.unique(np.asarray(customer_ids, dtype=np.int64))
+
+
+def pack_bitmap(bitmap):
+    """Serialise a bitmap as zlib-compressed little-endian ID deltas"""
+    return zlib.compress(np.diff(bitmap, prepend=0).astype("<i8").tobytes())
+
+
+def encode_bitmap(customer_ids):
+    """Pack customer IDs into a compressed bitmap"""
+    return pack_bitmap(bitmap_from_ids(customer_ids))
+
+
+def decode_bitmap(blob):
+    """Inverse of encode_bitmap, returning the sorted ID array"""
+    return np.cumsum(np.frombuffer(zlib.decompress(bytes(blob)), dtype="<i8"))
+
+
+def union_bitmaps(bitmaps):
+    """Union of any number of bitmaps"""
+    bitmaps = list(bitmaps)
+    return np.unique(np.concatenate(bitmaps)) if bitmaps else EMPTY_BITMAP
+
+
+def update_customer_bitmaps(engine, since=None, full=False):
+    """Incrementally (re)build monthly bitmaps from `sales`.
+
+    Months from `since` (the earliest sale date just loaded) onwards are
+    rebuilt, together with the latest stored month and any newer ones since
+    it may have been partial when it was last written. Pass full=True to
+    rebuild every month.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(BITMAP_TABLE_SQL))
+
+        start = None
+        if not full:
+            start = conn.execute(text("SELECT MAX(period) FROM customer_bitmaps")).scalar()
+            if start is not None and since is not None and pd.notna(since):
+                start = min(start, pd.Timestamp(since).to_period("M").to_timestamp().date())
+
+        if start is None:
+            conn.execute(text("DELETE FROM customer_bitmaps"))
+            since_sql, params = "", {"unknown": UNKNOWN_SEGMENT}
+        else:
+            conn.execute(text("DELETE FROM customer_bitmaps WHERE period >= :start"), {"start": start})
+            since_sql, params = "AND s.sale_date >= :start", {"start": start, "unknown": UNKNOWN_SEGMENT}
+
+        months = pd.read_sql(text(f"""
+            SELECT
+                DATE_TRUNC('month', s.sale_date)::date AS period,
+                COALESCE(c.city, :unknown) AS city,
+                COALESCE(p.categoty, :unknown) AS category,
+                ARRAY_AGG(DISTINCT s.customer_id) AS customer_ids
+            FROM sales s
+            JOIN products p ON s.product_id = p.product_id
+            JOIN customers c ON s.customer_id = c.customer_id
+            WHERE 1=1 {since_sql}
+            GROUP BY 1, 2, 3
+        """), conn, params=params)
+
+        rows = [
+            {
+                "period": row.period,
+                "city": row.city,
+                "category": row.category,
+                "customers": encode_bitmap(row.customer_ids)
+            }
+            for row in months.itertuples()
+        ]
+        if rows:
+            conn.execute(text("""
+                INSERT INTO customer_bitmaps (period, city, category, customers)
+                VALUES (:period, :city, :category, :customers)
+            """), rows)
+
+    return len(rows)
+
+
+def load_bitmaps(read_sql, city="All", category="All"):
+    """Per-month customer bitmaps for a city/category filter, keyed by month.
+
+    `read_sql(sql, params)` returns a frame, e.g. QueryGovernor.read_sql.
+    """
+    filters, params = "", {}
+    if city != "All":
+        filters += " AND city = :city"
+        params["city"] = city
+    if category != "All":
+        filters += " AND category = :category"
+        params["category"] = category
+
+    segments = read_sql(text(f"""
+        SELECT period, customers
+        FROM customer_bitmaps
+        WHERE 1=1 {filters}
+        ORDER BY period
+    """), params)
+
+    by_period = {}
+    for row in segments.itertuples():
+        period = pd.Timestamp(row.period).to_period("M")
+        by_period.setdefault(period, []).append(decode_bitmap(row.customers))
+    bitmaps = {period: union_bitmaps(parts) for period, parts in by_period.items()}
+    return bitmaps
+
+
+def retention_matrix(bitmaps, max_offset=12):
+    """Share of each monthly cohort still buying N months after its first purchase"""
+    seen = EMPTY_BITMAP
+    rows = {}
+    last = max(bitmaps, default=None)
+    for period in sorted(bitmaps):
+        cohort = np.setdiff1d(bitmaps[period], seen, assume_unique=True)
+        seen = np.union1d(seen, bitmaps[period])
+        if len(cohort) == 0:
+            continue
+        rows[str(period)] = {
+            offset: len(np.intersect1d(
+                cohort, bitmaps.get(period + offset, EMPTY_BITMAP), assume_unique=True
+            )) / len(cohort) * 100
+            for offset in range(max_offset + 1)
+            if period + offset <= last
+        }
+    return pd.DataFrame.from_dict(rows, orient="index").sort_index(axis=1)
+
+
+def repeat_rate(bitmaps):
+    """Percentage of customers who bought in more than one month"""
+    seen = repeat = EMPTY_BITMAP
+    for period in sorted(bitmaps):
+        repeat = np.union1d(repeat, np.intersect1d(seen, bitmaps[period], assume_unique=True))
+        seen = np.union1d(seen, bitmaps[period])
+    return len(repeat) / len(seen) * 100 if len(seen) else 0.0
+
+
+def churn_series(bitmaps):
+    """Month-over-month churn: last month's buyers who did not buy this month"""
+    records = []
+    if bitmaps:
+        first, last = min(bitmaps), max(bitmaps)
+        period = first + 1
+        while period <= last:
+            previous = bitmaps.get(period - 1, EMPTY_BITMAP)
+            current = bitmaps.get(period, EMPTY_BITMAP)
+            churned = len(np.setdiff1d(previous, current, assume_unique=True))
+            records.append({
+                "period": period.to_timestamp(),
+                "active": len(current),
+                "churned": churned,
+                "churn_rate": churned / len(previous) * 100 if len(previous) else 0.0
+            })
+            period += 1
+    return pd.DataFrame(records, columns=["period", "active", "churned", "churn_rate"])
+
+
+if __name__ == "__main__":
+    from scripts.db_router import DatabaseRouter
+
+    engine = DatabaseRouter.from_settings().writer()
+    written = update_customer_bitmaps(engine, full=True)
+    print(f"CUSTOMER BITMAPS REBUILT ✅ ({written} segments)")
@@ -0,0 +1,198 @@
+import itertools
+import os
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.pool import NullPool
+
+ENGINE_OPTIONS = dict(
+    pool_pre_ping=True,
+    pool_recycle=300,
+    pool_size=5,
+    max_overflow=5,
+    pool_timeout=30,
+    connect_args={"connect_timeout": 10}
+)
+
+# Lag probes get their own unpooled connections with short timeouts so an
+# unreachable replica is marked unhealthy in seconds rather than minutes
+PROBE_OPTIONS = dict(
+    poolclass=NullPool,
+    connect_args={"connect_timeout": 3, "options": "-c statement_timeout=3000"}
+)
+
+REPLICA_LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+
+def get_setting(name, default=None):
+    """Read a setting from the environment first, then .streamlit/secrets.toml"""
+    if name in os.environ:
+        return os.environ[name]
+    try:
+        import streamlit as st
+        return st.secrets.get(name, default)
+    except Exception:
+        return default
+
+
+def is_connection_error(exc):
+    """True when a DBAPIError means the server could not be reached or the connection dropped"""
+    if exc.connection_invalidated:
+        return True
+    # Connect failures carry no SQLSTATE, unlike errors raised by a query
+    return isinstance(exc, OperationalError) and getattr(exc.orig, "pgcode", None) is None
+
+
+def _url_list(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [url.strip() for url in value if url.strip()]
+
+
+class DatabaseRouter:
+    """Send writes to the primary and reads to lag-checked replicas.
+
+    Reads fall back to the primary when no replica is configured or every
+    replica is unreachable or further behind than max_lag_seconds. Replica
+    lag is probed in background threads, so reader() never waits on a probe.
+    """
+
+    def __init__(self, primary_url, replica_urls=(), snapshot_url=None,
+                 max_lag_seconds=30, lag_check_interval=10, **engine_options):
+        options = dict(ENGINE_OPTIONS, **engine_options)
+        self.primary = create_engine(primary_url, **options)
+        self.replicas = [create_engine(url, **options) for url in replica_urls]
+        self._probes = {
+            replica: create_engine(url, **PROBE_OPTIONS)
+            for replica, url in zip(self.replicas, replica_urls)
+        }
+        self.snapshot_source = create_engine(snapshot_url, **options) if snapshot_url else None
+        self.max_lag_seconds = max_lag_seconds
+        self.lag_check_interval = lag_check_interval
+        self._round_robin = itertools.count()
+        self._lock = threading.Lock()
+        self._health = {}
+        self._probing = set()
+        for replica in self.replicas:
+            self._probe_in_background(replica)
+
+    @classmethod
+    def from_settings(cls):
+        primary_url = get_setting("DB_PRIMARY_URL") or get_setting("DB_URL")
+        if not primary_url:
+            raise RuntimeError("Set DB_URL (or DB_PRIMARY_URL) in the environment or .streamlit/secrets.toml")
+        return cls(
+            primary_url,
+            replica_urls=_url_list(get_setting("DB_REPLICA_URLS")),
+            snapshot_url=get_setting("DB_SNAPSHOT_URL"),
+            max_lag_seconds=float(get_setting("MAX_REPLICA_LAG_SECONDS", 30)),
+            lag_check_interval=float(get_setting("LAG_CHECK_INTERVAL_SECONDS", 10))
+        )
+
+    def writer(self):
+        """Engine for inserts, DDL and anything that must see its own writes"""
+        return self.primary
+
+    def reader(self, blocking=False):
+        """Next healthy replica in round-robin order, else the primary.
+
+        Uses the last known replica health and refreshes stale entries in the
+        background; pass blocking=True to probe stale replicas inline instead.
+        """
+        if not self.replicas:
+            return self.primary
+        with self._lock:
+            start = next(self._round_robin) % len(self.replicas)
+        for engine in self.replicas[start:] + self.replicas[:start]:
+            if self._is_healthy(engine, blocking):
+                return engine
+        return self.primary
+
+    def read(self, fn):
+        """Call fn(engine) on a reader, retrying once on the primary if the replica is unreachable.
+
+        The failing replica is marked unhealthy straight away so later reads
+        skip it until a background probe sees it recover.
+        """
+        engine = self.reader()
+        if engine is self.primary:
+            return fn(engine)
+        try:
+            return fn(engine)
+        except DBAPIError as exc:
+            if not is_connection_error(exc):
+                raise
+            self.mark_unhealthy(engine)
+            return fn(self.primary)
+
+    def mark_unhealthy(self, engine):
+        """Stop routing reads to a replica until its next successful probe"""
+        with self._lock:
+            self._health[engine] = (time.monotonic(), False)
+
+    def replica_lag(self, engine):
+        """Replication lag of a replica's server in seconds (0 on a primary)"""
+        with self._probes.get(engine, engine).connect() as conn:
+            return float(conn.execute(text(REPLICA_LAG_SQL)).scalar())
+
+    def _is_healthy(self, engine, blocking=False):
+        checked_at, healthy = self._health.get(engine, (float("-inf"), False))
+        if time.monotonic() - checked_at < self.lag_check_interval:
+            return healthy
+        if blocking:
+            self._probe(engine)
+            return self._health[engine][1]
+        self._probe_in_background(engine)
+        return healthy
+
+    def _probe_in_background(self, engine):
+        with self._lock:
+            if engine in self._probing:
+                return
+            self._probing.add(engine)
+        threading.Thread(target=self._probe, args=(engine,), daemon=True).start()
+
+    def _probe(self, engine):
+        try:
+            healthy = self.replica_lag(engine) <= self.max_lag_seconds
+        except Exception:
+            healthy = False
+        with self._lock:
+            self._health[engine] = (time.monotonic(), healthy)
+            self._probing.discard(engine)
+
+    @contextmanager
+    def snapshot(self):
+        """Read-only REPEATABLE READ connection pinned to one snapshot.
+
+        Batch jobs run on DB_SNAPSHOT_URL or a replica. On a streaming replica
+        this only keeps vacuum on the primary unblocked when the replica runs
+        with hot_standby_feedback=off, and then a long job can be cancelled by
+        a recovery conflict (raise max_standby_streaming_delay or retry it).
+        With hot_standby_feedback=on the snapshot holds back vacuum on the
+        primary just as it would there. A restored copy or logical replica as
+        DB_SNAPSHOT_URL avoids both.
+        """
+        engine = self.snapshot_source
+        if engine is None:
+            engine = self.reader(blocking=True)
+            if engine is self.primary:
+                warnings.warn("No healthy replica available; pinning the snapshot on the primary")
+
+        with engine.connect().execution_options(
+            isolation_level="REPEATABLE READ",
+            postgresql_readonly=True
+        ) as conn, conn.begin():
+            yield conn
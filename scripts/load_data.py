@@ -1,8 +1,11 @@
 import pandas as pd
-import streamlit as st
-from sqlalchemy import create_engine
 
-engine = create_engine(st.secrets["DB_URL"])
+from scripts.cohorts import update_customer_bitmaps
+from scripts.db_router import DatabaseRouter
+from scripts.revenue_monitor import CHUNK_SIZE, consume_sales
+
+# Bulk loads always go to the primary
+engine = DatabaseRouter.from_settings().writer()
 
 customers = pd.DataFrame({
     "customer_id":[1,2,3],
@@ -27,6 +30,15 @@ sales = pd.DataFrame({
 
 customers.to_sql("customers",engine,if_exists="append",index=False)
 products.to_sql("products",engine,if_exists="append",index=False)
-sales.to_sql("sales",engine,if_exists="append",index=False)
+
+# Each sales chunk and its monitor update commit together
+sales = sales.sort_values("sale_date")
+for start in range(0, len(sales), CHUNK_SIZE):
+    chunk = sales.iloc[start:start + CHUNK_SIZE]
+    with engine.begin() as conn:
+        chunk.to_sql("sales",conn,if_exists="append",index=False)
+        consume_sales(conn, chunk)
+
+update_customer_bitmaps(engine, since=sales["sale_date"].min())
 
 print("DATA INSERTED INTO SUPABASE SUCCESSFULLY")
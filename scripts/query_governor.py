@@ -0,0 +1,103 @@
+import threading
+from concurrent.futures import Future
+
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeout
+
+# SQLSTATE raised by Postgres when statement_timeout cancels a query
+QUERY_CANCELED = "57014"
+
+
+class QueryTimeout(Exception):
+    """A query was not admitted in time, found no pooled connection or was cancelled by statement_timeout"""
+
+
+class StaleResult(Exception):
+    """Carries the last good result of a timed-out query.
+
+    Raised rather than returned so that callers wrapped in st.cache_data do
+    not cache it as fresh, and can tell the user the data is stale.
+    """
+
+    def __init__(self, frame, cause):
+        super().__init__(f"serving last good result: {cause}")
+        self.frame = frame
+
+
+class QueryGovernor:
+    """Admission control in front of pd.read_sql for shared dashboard queries.
+
+    Heavy queries share a fixed number of slots and run under a per-query
+    statement_timeout. Identical in-flight queries are coalesced into one
+    execution, and a timed-out query falls back to its last good result by
+    raising StaleResult. `engine` may also be a DatabaseRouter, in which case
+    reads go through DatabaseRouter.read and fall back to the primary when a
+    replica is unreachable.
+    """
+
+    def __init__(self, engine, max_heavy_queries=4, statement_timeout_ms=15000, admission_timeout=30):
+        self.engine = engine
+        self.statement_timeout_ms = statement_timeout_ms
+        self.admission_timeout = admission_timeout
+        self._slots = threading.BoundedSemaphore(max_heavy_queries)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._last_good = {}
+
+    def read_sql(self, sql, params=None, heavy=True, statement_timeout_ms=None, **kwargs):
+        """Governed equivalent of pd.read_sql(sql, engine, params=params, **kwargs)"""
+        key = (str(sql), repr(sorted((params or {}).items())), repr(sorted(kwargs.items())))
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+
+        if leader:
+            try:
+                result = self._execute(sql, params, heavy, statement_timeout_ms, kwargs)
+                self._last_good[key] = result
+                future.set_result(result)
+            except Exception as exc:
+                future.set_exception(exc)
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+
+        try:
+            return future.result().copy()
+        except QueryTimeout as exc:
+            if key in self._last_good:
+                raise StaleResult(self._last_good[key].copy(), exc) from exc
+            raise
+
+    def _execute(self, sql, params, heavy, statement_timeout_ms, kwargs):
+        if heavy and not self._slots.acquire(timeout=self.admission_timeout):
+            raise QueryTimeout(f"no heavy query slot free after {self.admission_timeout}s")
+
+        timeout_ms = statement_timeout_ms or self.statement_timeout_ms
+
+        def run(engine):
+            with engine.connect() as conn, conn.begin():
+                # set_config(..., true) scopes the timeout to this transaction only
+                conn.execute(
+                    text("SELECT set_config('statement_timeout', :timeout, true)"),
+                    {"timeout": str(int(timeout_ms))}
+                )
+                return pd.read_sql(sql, conn, params=params, **kwargs)
+
+        try:
+            if hasattr(self.engine, "read"):
+                return self.engine.read(run)
+            return run(self.engine)
+        except PoolTimeout as exc:
+            raise QueryTimeout("no pooled connection free") from exc
+        except OperationalError as exc:
+            if getattr(exc.orig, "pgcode", None) == QUERY_CANCELED:
+                raise QueryTimeout(f"query cancelled after {timeout_ms}ms") from exc
+            raise
+        finally:
+            if heavy:
+                self._slots.release()
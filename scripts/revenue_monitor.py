@@ -0,0 +1,332 @@
+import math
+import zlib
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from scripts.cohorts import EMPTY_BITMAP, UNKNOWN_SEGMENT, bitmap_from_ids, pack_bitmap, decode_bitmap
+
+EWMA_ALPHA = 0.1
+Z_THRESHOLD = 3.0
+MIN_DAYS = 7
+# Standard deviation never assumed below this share of the mean, so a spike
+# after a flat history is still flagged
+VARIANCE_FLOOR = 0.05
+# Days without sales closed as zero-revenue days before the next sale
+MAX_GAP_DAYS = 31
+CHUNK_SIZE = 10000
+DAYS_IN_MONTH = 31
+
+# One row per (city, category) segment, with "All" as the wildcard, so the
+# dashboard reads any filter combination with a single primary-key lookup.
+# Current and previous month totals are kept per day of month, and customer
+# sets carry each customer's first purchase day, so month-to-date can be
+# compared with the same day range of the previous month.
+STATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS revenue_monitor_state (
+    city VARCHAR(50) NOT NULL,
+    category VARCHAR(50) NOT NULL,
+    current_day DATE,
+    day_revenue DOUBLE PRECISION NOT NULL DEFAULT 0,
+    ewma_mean DOUBLE PRECISION NOT NULL DEFAULT 0,
+    ewma_var DOUBLE PRECISION NOT NULL DEFAULT 0,
+    days_seen INT NOT NULL DEFAULT 0,
+    period_start DATE,
+    period_daily_revenue DOUBLE PRECISION[],
+    period_daily_orders INT[],
+    period_customers BYTEA,
+    period_customer_days BYTEA,
+    prev_period_daily_revenue DOUBLE PRECISION[],
+    prev_period_daily_orders INT[],
+    prev_period_customers BYTEA,
+    prev_period_customer_days BYTEA,
+    alert_day DATE,
+    alert_revenue DOUBLE PRECISION,
+    alert_z DOUBLE PRECISION,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (city, category)
+)
+"""
+
+PERIODS = ("period_", "prev_period_")
+
+STATE_COLUMNS = [
+    "city", "category", "current_day", "day_revenue", "ewma_mean", "ewma_var", "days_seen",
+    "period_start",
+    "period_daily_revenue", "period_daily_orders", "period_customers", "period_customer_days",
+    "prev_period_daily_revenue", "prev_period_daily_orders", "prev_period_customers", "prev_period_customer_days",
+    "alert_day", "alert_revenue", "alert_z"
+]
+
+NO_DAYS = np.empty(0, dtype=np.int8)
+
+
+def _reset_period(state, prefix):
+    state.update({
+        prefix + "daily_revenue": [0.0] * DAYS_IN_MONTH,
+        prefix + "daily_orders": [0] * DAYS_IN_MONTH,
+        prefix + "customers": EMPTY_BITMAP,
+        prefix + "customer_days": NO_DAYS
+    })
+
+
+def _new_state(city, category):
+    state = dict.fromkeys(STATE_COLUMNS)
+    state.update(city=city, category=category, day_revenue=0.0, ewma_mean=0.0, ewma_var=0.0, days_seen=0)
+    for prefix in PERIODS:
+        _reset_period(state, prefix)
+    return state
+
+
+def _add_first_days(ids, days, new_ids, day):
+    """Union of two customer sets, keeping each customer's earliest purchase day"""
+    all_ids = np.concatenate([ids, new_ids])
+    all_days = np.concatenate([days, np.full(len(new_ids), day, dtype=np.int8)])
+    order = np.lexsort((all_days, all_ids))
+    all_ids, all_days = all_ids[order], all_days[order]
+    first = np.ones(len(all_ids), dtype=bool)
+    first[1:] = all_ids[1:] != all_ids[:-1]
+    return all_ids[first], all_days[first]
+
+
+def _native(value):
+    """numpy scalars and NaN from pd.read_sql back to values psycopg2 can bind"""
+    if hasattr(value, "item"):
+        value = value.item()
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+
+def _close_day(state):
+    """Fold the finished day into the EWMA statistics, flagging it if it is an outlier"""
+    revenue = state["day_revenue"]
+    if state["days_seen"] == 0:
+        state["ewma_mean"], state["ewma_var"] = revenue, 0.0
+    else:
+        variance = max(state["ewma_var"], (VARIANCE_FLOOR * state["ewma_mean"]) ** 2)
+        if state["days_seen"] >= MIN_DAYS and variance > 0:
+            z = (revenue - state["ewma_mean"]) / math.sqrt(variance)
+            if abs(z) >= Z_THRESHOLD:
+                state.update(alert_day=state["current_day"], alert_revenue=revenue, alert_z=z)
+        diff = revenue - state["ewma_mean"]
+        increment = EWMA_ALPHA * diff
+        state["ewma_mean"] += increment
+        state["ewma_var"] = (1 - EWMA_ALPHA) * (state["ewma_var"] + diff * increment)
+    state["days_seen"] += 1
+
+
+def _previous_month(month):
+    return (month - timedelta(days=1)).replace(day=1)
+
+
+def _add_to_period(state, prefix, day, revenue, orders, customers):
+    state[prefix + "daily_revenue"][day.day - 1] += revenue
+    state[prefix + "daily_orders"][day.day - 1] += orders
+    state[prefix + "customers"], state[prefix + "customer_days"] = _add_first_days(
+        state[prefix + "customers"], state[prefix + "customer_days"], customers, day.day
+    )
+
+
+def _observe(state, day, revenue, orders, customers):
+    """Apply one (segment, day) aggregate, in day order, to a segment's state"""
+    month = day.replace(day=1)
+
+    if state["period_start"] is None or month > state["period_start"]:
+        if state["period_start"] is not None and _previous_month(month) == state["period_start"]:
+            for field in ("daily_revenue", "daily_orders", "customers", "customer_days"):
+                state["prev_period_" + field] = state["period_" + field]
+        else:
+            _reset_period(state, "prev_period_")
+        _reset_period(state, "period_")
+        state["period_start"] = month
+
+    if month == state["period_start"]:
+        _add_to_period(state, "period_", day, revenue, orders, customers)
+    elif month == _previous_month(state["period_start"]):
+        # Late rows for the previous month still count towards its totals
+        _add_to_period(state, "prev_period_", day, revenue, orders, customers)
+
+    # Days already folded into the EWMA are not revisited
+    if state["current_day"] is None:
+        state.update(current_day=day, day_revenue=revenue)
+    elif day == state["current_day"]:
+        state["day_revenue"] += revenue
+    elif day > state["current_day"]:
+        _close_day(state)
+        # Days in between had no sales for this segment: fold them in as zero
+        # revenue so the mean is not biased upwards and drops get flagged
+        gap = (day - state["current_day"]).days - 1
+        for offset in range(max(gap - MAX_GAP_DAYS, 0), gap):
+            state.update(current_day=day - timedelta(days=gap - offset), day_revenue=0.0)
+            _close_day(state)
+        state.update(current_day=day, day_revenue=revenue)
+
+
+def _unpack_days(blob):
+    return np.frombuffer(zlib.decompress(bytes(blob)), dtype=np.int8) if blob is not None else NO_DAYS
+
+
+def _pack_days(days):
+    return zlib.compress(days.astype(np.int8).tobytes())
+
+
+def _state_from_row(row):
+    """Stored state row back into the in-memory form used by _observe"""
+    row = {column: _native(value) for column, value in row.items()}
+    state = _new_state(row["city"], row["category"])
+    for column in ("current_day", "day_revenue", "ewma_mean", "ewma_var", "days_seen",
+                   "alert_revenue", "alert_z"):
+        state[column] = row[column]
+    for column in ("current_day", "period_start", "alert_day"):
+        state[column] = pd.Timestamp(row[column]).date() if pd.notna(row[column]) else None
+    for prefix in PERIODS:
+        if row[prefix + "daily_revenue"] is not None:
+            state[prefix + "daily_revenue"] = [float(v) for v in row[prefix + "daily_revenue"]]
+            state[prefix + "daily_orders"] = [int(v) for v in row[prefix + "daily_orders"]]
+        if row[prefix + "customers"] is not None:
+            state[prefix + "customers"] = decode_bitmap(row[prefix + "customers"])
+            state[prefix + "customer_days"] = _unpack_days(row[prefix + "customer_days"])
+    return state
+
+
+def consume_sales(conn, chunk):
+    """Update monitor state from a chunk of newly inserted `sales` rows.
+
+    Call with the same connection/transaction that wrote the chunk so the
+    state never drifts from the table it summarises.
+    """
+    chunk = chunk.dropna(subset=["customer_id", "product_id"])
+    if chunk.empty:
+        return
+    conn.execute(text(STATE_TABLE_SQL))
+
+    products = pd.read_sql(text("""
+        SELECT product_id, price::float8 AS price, categoty AS category
+        FROM products WHERE product_id = ANY(:ids)
+    """), conn, params={"ids": [int(i) for i in chunk["product_id"].unique()]})
+    customers = pd.read_sql(text("""
+        SELECT customer_id, city
+        FROM customers WHERE customer_id = ANY(:ids)
+    """), conn, params={"ids": [int(i) for i in chunk["customer_id"].unique()]})
+
+    rows = chunk.merge(products, on="product_id").merge(customers, on="customer_id")
+    # Nothing to record when every row lost its product or customer in the joins
+    if rows.empty:
+        return
+    rows["sale_date"] = pd.to_datetime(rows["sale_date"]).dt.date
+    rows["revenue"] = rows["quantity"] * rows["price"]
+    rows[["city", "category"]] = rows[["city", "category"]].fillna(UNKNOWN_SEGMENT)
+
+    segments = pd.concat([
+        rows,
+        rows.assign(city="All"),
+        rows.assign(category="All"),
+        rows.assign(city="All", category="All")
+    ])
+    daily = segments.groupby(["city", "category", "sale_date"], as_index=False).agg(
+        revenue=("revenue", "sum"),
+        orders=("revenue", "size"),
+        customer_ids=("customer_id", list)
+    ).sort_values("sale_date")
+
+    # Only lock and decode the segments this chunk touches, "All" rows included
+    keys = daily[["city", "category"]].drop_duplicates()
+    stored = pd.read_sql(text("""
+        SELECT * FROM revenue_monitor_state
+        WHERE (city, category) IN (
+            SELECT * FROM UNNEST(CAST(:cities AS VARCHAR[]), CAST(:categories AS VARCHAR[]))
+        )
+        FOR UPDATE
+    """), conn, params={"cities": list(keys["city"]), "categories": list(keys["category"])})
+    states = {(row["city"], row["category"]): _state_from_row(row) for row in stored.to_dict("records")}
+
+    touched = set()
+    for row in daily.itertuples():
+        key = (row.city, row.category)
+        state = states.setdefault(key, _new_state(*key))
+        _observe(state, row.sale_date, float(row.revenue), int(row.orders), bitmap_from_ids(row.customer_ids))
+        touched.add(key)
+
+    updates = []
+    for key in touched:
+        update = dict(states[key])
+        for prefix in PERIODS:
+            update[prefix + "customers"] = pack_bitmap(update[prefix + "customers"])
+            update[prefix + "customer_days"] = _pack_days(update[prefix + "customer_days"])
+        updates.append(update)
+
+    assignments = ", ".join(f"{c} = EXCLUDED.{c}" for c in STATE_COLUMNS[2:])
+    conn.execute(text(f"""
+        INSERT INTO revenue_monitor_state ({", ".join(STATE_COLUMNS)}, updated_at)
+        VALUES ({", ".join(":" + c for c in STATE_COLUMNS)}, NOW())
+        ON CONFLICT (city, category) DO UPDATE SET {assignments}, updated_at = NOW()
+    """), updates)
+
+
+def _pct_change(current, previous):
+    return (current - previous) / previous * 100 if previous else None
+
+
+def load_kpi_deltas(read_sql, city="All", category="All"):
+    """Month-to-date KPIs against the same days of the previous month, plus the latest alert.
+
+    `read_sql(sql, params)` returns a frame, e.g. QueryGovernor.read_sql.
+
+    Each KPI is a dict with the month-to-date value ("current"), the value over
+    the same day range of the previous month ("previous") and the percentage
+    change between them ("change", None when there is nothing to compare).
+    """
+    stored = read_sql(text("""
+        SELECT * FROM revenue_monitor_state
+        WHERE city = :city AND category = :category
+    """), {"city": city, "category": category})
+    if stored.empty:
+        return None
+
+    state = _state_from_row(stored.iloc[0].to_dict())
+    through_day = state["current_day"].day
+
+    def same_days(prefix):
+        revenue = sum(state[prefix + "daily_revenue"][:through_day])
+        orders = sum(state[prefix + "daily_orders"][:through_day])
+        customers = int((state[prefix + "customer_days"] <= through_day).sum())
+        return {
+            "revenue": revenue,
+            "customers": customers,
+            "orders": orders,
+            "avg_order_value": revenue / orders if orders else 0
+        }
+
+    current, previous = same_days("period_"), same_days("prev_period_")
+
+    alert = None
+    if state["alert_day"] is not None and state["alert_day"] >= state["period_start"]:
+        alert = {"day": pd.Timestamp(state["alert_day"]), "revenue": state["alert_revenue"], "z": state["alert_z"]}
+
+    deltas = {
+        key: {"current": current[key], "previous": previous[key], "change": _pct_change(current[key], previous[key])}
+        for key in current
+    }
+    deltas.update(period_start=pd.Timestamp(state["period_start"]), through_day=through_day, alert=alert)
+    return deltas
+
+
+if __name__ == "__main__":
+    from scripts.db_router import DatabaseRouter
+
+    # Rebuild the monitor state by replaying every sale in date order
+    engine = DatabaseRouter.from_settings().writer()
+    with engine.begin() as conn:
+        conn.execute(text(STATE_TABLE_SQL))
+        conn.execute(text("DELETE FROM revenue_monitor_state"))
+
+    with engine.connect().execution_options(stream_results=True) as reader:
+        for chunk in pd.read_sql(text("""
+            SELECT customer_id, product_id, quantity, sale_date
+            FROM sales ORDER BY sale_date
+        """), reader, chunksize=CHUNK_SIZE):
+            with engine.begin() as conn:
+                consume_sales(conn, chunk)
+
+    print("REVENUE MONITOR STATE REBUILT ✅")